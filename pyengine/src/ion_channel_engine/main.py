@@ -1,7 +1,8 @@
 import sys
 import os
-import json
+import multiprocessing
 import numpy as np
+import orjson
 
 # Add the script's own directory to the Python path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -9,29 +10,56 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from schemas import ChannelModel, StimulusProtocolSchema
 from simulation import SimulationEngine
 
-# Helper class to convert numpy arrays in the result to lists
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        return json.JSONEncoder.default(self, obj)
+# Fallback for anything orjson can't serialize natively (e.g. non-contiguous arrays)
+def _to_serializable(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
 
-def run_simulation():
+def write_results(results):
+    """Writes the results dictionary to stdout as JSON."""
+    payload = orjson.dumps(results, default=_to_serializable, option=orjson.OPT_SERIALIZE_NUMPY)
+    # Flush any text already printed so it doesn't land after the binary write
+    sys.stdout.flush()
+    sys.stdout.buffer.write(payload)
+    sys.stdout.buffer.flush()
+
+def _engine_run_one(model_data, protocol_data, duration_ms, steps):
+    """
+    Pool worker: validates plain dicts and runs a single simulation, so only
+    JSON-like data (not pydantic objects) has to be pickled to the worker.
+    """
+    model = ChannelModel(**model_data)
+    protocol = StimulusProtocolSchema(**protocol_data)
+    engine = SimulationEngine(model, protocol)
+    return engine.run(duration_ms=duration_ms, steps=steps)
+
+def run_batch(model_data, protocols, duration_ms, steps):
+    """
+    Runs the model against every protocol in parallel, one worker per CPU core.
+    Returns the result dictionaries in the same order as the protocols.
+    """
+    jobs = [(model_data, protocol_data, duration_ms, steps) for protocol_data in protocols]
+    num_workers = max(1, min(os.cpu_count() or 1, len(jobs)))
+    with multiprocessing.Pool(num_workers) as pool:
+        return pool.starmap(_engine_run_one, jobs)
+
+def run_simulation(batch=False):
     try:
         # Read the model and protocol JSON from standard input
-        input_data = json.load(sys.stdin)
-        
-        # Validate the data using your Pydantic schemas
-        model = ChannelModelSchema(**input_data['model'])
-        protocol = StimulusProtocolSchema(**input_data['protocol'])
-        
-        # Initialize and run the engine
-        engine = SimulationEngine(model, protocol)
-        results = engine.run(duration_ms=input_data['duration_ms'], steps=input_data['steps'])
+        input_data = orjson.loads(sys.stdin.buffer.read())
+
+        if batch:
+            # Batch mode: a 'protocols' array is run in parallel against the same model
+            results = run_batch(input_data['model'], input_data['protocols'], input_data['duration_ms'], input_data['steps'])
+        else:
+            results = _engine_run_one(input_data['model'], input_data['protocol'], input_data['duration_ms'], input_data['steps'])
         
-        # Print the final results dictionary as a JSON string to stdout
-        # Use the custom encoder to handle numpy arrays
-        print(json.dumps(results, cls=NumpyEncoder))
+        # Write the final results dictionary to stdout; orjson serializes
+        # numpy arrays directly from their memory without building Python lists
+        write_results(results)
 
     except Exception as e:
         # If anything goes wrong, print the error to stderr and exit
@@ -40,4 +68,4 @@ def run_simulation():
 
 
 if __name__ == '__main__':
-    run_simulation()
\ No newline at end of file
+    run_simulation(batch='--batch' in sys.argv[1:])
\ No newline at end of file
@@ -1,14 +1,14 @@
 import json
-from typing import List, Dict
+import math
+from collections import namedtuple
+from typing import List, Dict, Optional, Tuple
 
-# This import was missing
-import matplotlib.pyplot as plt
 import numpy as np
-import sympy
-# Corrected sympy import statement
-from sympy.parsing.sympy_parser import parse_expr
 from pydantic import BaseModel, Field
 from scipy.integrate import solve_ivp
+from scipy.linalg import expm
+from scipy.sparse.linalg import expm_multiply
+from numba import njit
 
 
 from schemas import ChannelModel, StimulusProtocol, HoldingValue, FluxStep
@@ -23,31 +23,393 @@ class Stimulus:
             hv.name: hv for hv in self.protocol.holding_values
         }
 
+        # Piecewise-linear form of every variable, so lookups are a single searchsorted
+        self._piecewise = {
+            name: self._build_piecewise(hv) for name, hv in self.holding_map.items()
+        }
+
+    @staticmethod
+    def _build_piecewise(holding_value: HoldingValue):
+        """
+        Splits a variable's timeline at every epoch boundary. Piece i starts at
+        breakpoints[i] (the first at -inf, for the holding value) and has the value
+        values[i] + slopes[i] * (t_ms - anchors[i]) until the next breakpoint.
+        """
+        value = holding_value.value
+        fluxes = holding_value.fluxSteps
+        bounds = sorted({float(t_ms) for flux in fluxes for t_ms in (flux.time, flux.time + flux.deltaTime)})
+
+        breakpoints, values, slopes = [-np.inf], [value], [0.0]
+        for start in bounds:
+            # No boundary falls inside a piece, so the epoch active at its start covers all of it
+            piece_value, slope = value, 0.0
+            for flux in fluxes:
+                if flux.time <= start < flux.time + flux.deltaTime:
+                    if flux.type == 'Step':
+                        piece_value = flux.value
+                    elif flux.type == 'Ramp':
+                        slope = (flux.value - value) / flux.deltaTime
+                        piece_value = value + (start - flux.time) * slope
+                    break
+            breakpoints.append(start)
+            values.append(piece_value)
+            slopes.append(slope)
+
+        breakpoints = np.array(breakpoints)
+        anchors = np.where(np.isinf(breakpoints), 0.0, breakpoints)
+        return breakpoints, anchors, np.array(values), np.array(slopes)
+
+    def get_values(self, variable_name: str, t_ms: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Vectorized get_value_at_time: the value of a variable at every time in t_ms,
+        found with one searchsorted over the epoch boundaries.
+        """
+        piecewise = self._piecewise.get(variable_name)
+        if piecewise is None:
+            return None
+
+        breakpoints, anchors, values, slopes = piecewise
+        idx = np.searchsorted(breakpoints, t_ms, side='right') - 1
+        return values[idx] + slopes[idx] * (t_ms - anchors[idx])
 
     def get_value_at_time(self, variable_name: str, t_ms: float) -> Optional[float]:
         """
         Finds the value of a variable at a specific time t_ms by checking epochs.
         If no epoch is active, returns the holding value.
         """
-        # Default to the holding value
-        holding_value = self.holding_mape.get(variable_name)
-        if not holding_value:
+        values = self.get_values(variable_name, np.array([t_ms], dtype=np.float64))
+        if values is None:
             return None
+        return float(values[0])
 
-        value = holding_value.value
+    def get_segments(self, variable_name: str, duration_ms: float) -> List[Tuple[float, float, float, float]]:
+        """
+        Splits [0, duration_ms] at every epoch boundary into pieces over which the
+        variable is either constant or changes linearly.
+        Returns (start_ms, end_ms, value_at_start, slope_per_ms) tuples.
+        """
+        piecewise = self._piecewise.get(variable_name)
+        if piecewise is None:
+            breakpoints, anchors, values, slopes = np.array([-np.inf]), np.zeros(1), np.zeros(1), np.zeros(1)
+        else:
+            breakpoints, anchors, values, slopes = piecewise
+
+        bounds = {0.0, float(duration_ms)}
+        bounds.update(float(t_ms) for t_ms in breakpoints if 0 < t_ms < duration_ms)
+        bounds = sorted(bounds)
+
+        segments = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            idx = np.searchsorted(breakpoints, start, side='right') - 1
+            segment_value = values[idx] + slopes[idx] * (start - anchors[idx])
+            segments.append((start, end, float(segment_value), float(slopes[idx])))
+        return segments
+
+# Maximum number of distinct voltages whose rate values are memoized at once
+RATE_CACHE_SIZE = 128
+
+# Above this many states, dense expm of the segment generator gets expensive and
+# constant segments are propagated with expm_multiply instead
+DENSE_EXPM_MAX_STATES = 20
+
+# Reduced generators worse conditioned than this have no reliable steady state, and
+# their constant segments are propagated with the full generator instead
+STEADY_STATE_MAX_COND = 1e10
+
+# Eigenvector matrices worse conditioned than this (near-defective generators) lose
+# too much precision in the diagonalized propagator, so expm stepping is used instead
+EIGENVECTOR_MAX_COND = 1e8
+
+# Parsed rate equations keyed by ((rate_function_id, equation), ...). The channel id
+# isn't part of the key, so any models sharing the same equations reuse one entry
+_prepared_rate_equations = {}
+
+# Structure-of-arrays view of the model's transitions: one contiguous array per field,
+# index k describing transition k. Passed to the compiled kernels as a single argument
+TransitionsSoA = namedtuple('TransitionsSoA', ['from_idx', 'to_idx', 'mult', 'fn_idx'])
+
+# --- Compiled Kernels ---
 
-        for flux in holding_value.fluxSteps:
-            start = flux.time
-            end = start + flux.deltaTime
-            if start <= t_ms < end:
-                if flux.type == 'Step'"
-                return flux.value
+@njit(cache=True, fastmath=True)
+def _fill_q(Q, rates, tr):
+    """Fills the preallocated Q-matrix (or a view into one) in place from the TransitionsSoA."""
+    Q[:, :] = 0.0
+    for k in range(tr.from_idx.shape[0]):
+        rate = rates[tr.fn_idx[k]] * tr.mult[k]
+        Q[tr.to_idx[k], tr.from_idx[k]] += rate
+        Q[tr.from_idx[k], tr.from_idx[k]] -= rate
 
-            elif flux.type == 'Ramp':
-                progress = (t_ms - start) / flux.deltaTime
-                return value + progress * (flux.value - value)
 
-            return value
+@njit(cache=True, fastmath=True)
+def _rhs(y, V, rates, tr, conductances, nernst_coef, flux_coef, vint, vext):
+    """
+    Compiled right-hand side of the ODE system. Takes only arrays and scalars so
+    every solver call runs as a tight loop with no Python dispatch.
+    rates holds one value per unique rate function, fanned out via tr.fn_idx.
+
+    Probabilities are conserved, so y only carries the first num_states - 1 of
+    them (followed by the two K+ concentrations); the last is 1 - sum(others).
+    """
+    num_free = conductances.shape[0] - 1
+
+    p_last = 1.0
+    for i in range(num_free):
+        p_last -= y[i]
+
+    # The solver keeps references to returned derivatives, so this one can't be reused
+    dydt = np.zeros(num_free + 2)
+
+    # Apply Q to the probabilities one transition at a time: O(transitions)
+    # work instead of building and multiplying a dense num_states^2 matrix
+    for k in range(tr.from_idx.shape[0]):
+        source, target = tr.from_idx[k], tr.to_idx[k]
+        p_source = y[source] if source < num_free else p_last
+        state_flux = rates[tr.fn_idx[k]] * tr.mult[k] * p_source
+        if target < num_free:
+            dydt[target] += state_flux
+        if source < num_free:
+            dydt[source] -= state_flux
+
+    total_conductance = conductances[num_free] * p_last
+    for i in range(num_free):
+        total_conductance += conductances[i] * y[i]
+
+    internal_K_mM = y[num_free]
+    external_K_mM = y[num_free + 1]
+    if internal_K_mM <= 0 or external_K_mM <= 0:
+        nernst_potential = 0.0
+    else:
+        nernst_potential = nernst_coef * np.log(external_K_mM / internal_K_mM)
+
+    total_current_pA = total_conductance * (V - nernst_potential)
+
+    flux_mmol_s = total_current_pA * flux_coef
+    dydt[num_free] = -flux_mmol_s / vint
+    dydt[num_free + 1] = flux_mmol_s / vext
+    return dydt
+
+
+@njit(cache=True, fastmath=True)
+def _jac(y, V, rates, tr, conductances, nernst_coef, flux_coef, vint, vext):
+    """
+    Analytic Jacobian of _rhs with respect to the reduced y. Takes the same arguments.
+    The probability block is Q with the last state substituted out; the
+    concentration rows come from differentiating the flux through the
+    conductance and Nernst terms.
+    """
+    num_states = conductances.shape[0]
+    num_free = num_states - 1
+
+    Q = np.zeros((num_states, num_states))
+    _fill_q(Q, rates, tr)
+
+    J = np.zeros((num_free + 2, num_free + 2))
+    # With p_last = 1 - sum(p_free): d(dp_i/dt)/dp_j = Q[i, j] - Q[i, last]
+    for i in range(num_free):
+        for j in range(num_free):
+            J[i, j] = Q[i, j] - Q[i, num_free]
+
+    internal_K_mM = y[num_free]
+    external_K_mM = y[num_free + 1]
+    concentrations_valid = internal_K_mM > 0 and external_K_mM > 0
+    if concentrations_valid:
+        nernst_potential = nernst_coef * np.log(external_K_mM / internal_K_mM)
+    else:
+        nernst_potential = 0.0
+
+    p_last = 1.0
+    total_conductance = 0.0
+    for j in range(num_free):
+        p_last -= y[j]
+        total_conductance += conductances[j] * y[j]
+        d_flux = flux_coef * (conductances[j] - conductances[num_free]) * (V - nernst_potential)
+        J[num_free, j] = -d_flux / vint
+        J[num_free + 1, j] = d_flux / vext
+    total_conductance += conductances[num_free] * p_last
+
+    if concentrations_valid:
+        # d(flux)/dK through the Nernst potential
+        d_flux_int = flux_coef * total_conductance * nernst_coef / internal_K_mM
+        d_flux_ext = -flux_coef * total_conductance * nernst_coef / external_K_mM
+        J[num_free, num_free] = -d_flux_int / vint
+        J[num_free, num_free + 1] = -d_flux_ext / vint
+        J[num_free + 1, num_free] = d_flux_int / vext
+        J[num_free + 1, num_free + 1] = d_flux_ext / vext
+    return J
+
+
+@njit(cache=True, fastmath=True)
+def _walk_grid(step, out, grid_size):
+    """
+    Fills out[1:grid_size] by repeatedly applying the one-step propagator to
+    out[0]. A fused compiled loop, so walking thousands of samples doesn't
+    pay a Python-level matmul per sample.
+    """
+    size, num_columns = step.shape[0], out.shape[2]
+    for i in range(1, grid_size):
+        for r in range(size):
+            for c in range(num_columns):
+                acc = 0.0
+                for k in range(size):
+                    acc += step[r, k] * out[i - 1, k, c]
+                out[i, r, c] = acc
+
+
+@njit(cache=True, fastmath=True)
+def _step_concentrations(charge_nS_s, V, internal_K_mM, external_K_mM,
+                         nernst_coef, flux_coef, vint, vext, internal_out, external_out):
+    """
+    Steps the K+ concentrations across the samples of a constant-voltage segment,
+    given the cumulative charge-weighted conductance integral at each sample.
+    The Nernst potential is held at its value from the start of each step, and is
+    only re-evaluated when a step actually moved the concentrations.
+    """
+    if internal_K_mM > 0.0 and external_K_mM > 0.0:
+        nernst_potential = nernst_coef * np.log(external_K_mM / internal_K_mM)
+    else:
+        nernst_potential = 0.0
+
+    charge_prev = 0.0
+    for i in range(charge_nS_s.shape[0]):
+        flux_mmol = (charge_nS_s[i] - charge_prev) * (V - nernst_potential) * flux_coef
+        if flux_mmol != 0.0:
+            internal_K_mM -= flux_mmol / vint
+            external_K_mM += flux_mmol / vext
+            if internal_K_mM > 0.0 and external_K_mM > 0.0:
+                nernst_potential = nernst_coef * np.log(external_K_mM / internal_K_mM)
+            else:
+                nernst_potential = 0.0
+        internal_out[i] = internal_K_mM
+        external_out[i] = external_K_mM
+        charge_prev = charge_nS_s[i]
+
+
+@njit(cache=True, fastmath=True)
+def _fill_output_traces(y_trace, voltage_trace, conductances, nernst_coef,
+                        probabilities_out, conductance_out, current_out, nernst_out):
+    """
+    Derives every per-sample output from the integrated trace in a single pass:
+    the implied last-state probability, total conductance, Nernst potential and
+    current, written straight into the (float32) output arrays.
+    """
+    num_free = conductances.shape[0] - 1
+    nernst_potential = 0.0
+    for i in range(y_trace.shape[1]):
+        p_last = 1.0
+        total_conductance = 0.0
+        for j in range(num_free):
+            p = y_trace[j, i]
+            probabilities_out[j, i] = p
+            p_last -= p
+            total_conductance += conductances[j] * p
+        probabilities_out[num_free, i] = p_last
+        total_conductance += conductances[num_free] * p_last
+
+        # The log is only needed when the concentrations moved since the last sample;
+        # avoid division by zero if they drop to or below zero
+        internal_K_mM = y_trace[num_free, i]
+        external_K_mM = y_trace[num_free + 1, i]
+        if i == 0 or internal_K_mM != y_trace[num_free, i - 1] or external_K_mM != y_trace[num_free + 1, i - 1]:
+            if internal_K_mM > 0.0 and external_K_mM > 0.0:
+                nernst_potential = nernst_coef * np.log(external_K_mM / internal_K_mM)
+            else:
+                nernst_potential = 0.0
+
+        conductance_out[i] = total_conductance
+        current_out[i] = total_conductance * (voltage_trace[i] - nernst_potential)
+        nernst_out[i] = nernst_potential
+
+
+def _build_rate_kernel(expressions):
+    """
+    Generates a plain-Python function that evaluates each unique rate expression
+    once and writes the results into a preallocated array. It is only called on
+    a _rates_at cache miss, so it isn't JIT-compiled: exec'd source can't use
+    numba's on-disk cache and would pay the compile on every engine.
+    """
+    import sympy
+
+    # Pull shared subexpressions (e.g. a common exp(-V/k)) out into locals
+    replacements, reduced = sympy.cse(expressions)
+
+    lines = ["def _rate_kernel(V, out):"]
+    for symbol, subexpr in replacements:
+        lines.append(f"    {symbol} = {sympy.pycode(subexpr)}")
+    for k, expr in enumerate(reduced):
+        lines.append(f"    out[{k}] = {sympy.pycode(expr)}")
+    lines.append("    return out")
+
+    namespace = {'math': math}
+    exec("\n".join(lines), namespace)
+    return namespace['_rate_kernel']
+
+
+def _build_rate_batch(expressions):
+    """
+    Generates a NumPy function evaluating every unique rate expression over an
+    array of voltages in one call, returning an (n_rates, len(V)) array. Used to
+    fill the rate cache for all constant-voltage segments of a run at once.
+    """
+    import sympy
+    from sympy.printing.numpy import NumPyPrinter
+
+    printer = NumPyPrinter()
+    replacements, reduced = sympy.cse(expressions)
+
+    lines = ["def _rate_batch(V):"]
+    for symbol, subexpr in replacements:
+        lines.append(f"    {symbol} = {printer.doprint(subexpr)}")
+    lines.append(f"    out = numpy.empty(({len(reduced)}, len(V)))")
+    for k, expr in enumerate(reduced):
+        # Constant rates are scalars here and broadcast across the row
+        lines.append(f"    out[{k}] = {printer.doprint(expr)}")
+    lines.append("    return out")
+
+    namespace = {'numpy': np}
+    exec("\n".join(lines), namespace)
+    return namespace['_rate_batch']
+
+
+def _expm_multiply_at(A, B, offsets, grid_size):
+    """
+    Evaluates expm(A * t) @ B for every t in offsets. The first grid_size offsets
+    form a uniform grid (the samples of a stimulus segment); any after that (its
+    end point) are off the grid. Small generators are diagonalized once, so each
+    offset costs only elementwise exponentials; if the eigenvectors are too
+    ill-conditioned, the grid is walked with a single cached one-step propagator.
+    """
+    num_points = len(offsets)
+    # A lone sample is no grid to walk, so it's evaluated like an off-grid point
+    grid_size = grid_size if grid_size >= 2 else 0
+
+    results = np.empty((num_points,) + B.shape)
+    if A.shape[0] > DENSE_EXPM_MAX_STATES + 1:
+        # Large models: action of the exponential on B without forming expm(A * dt)
+        if grid_size:
+            results[:grid_size] = expm_multiply(
+                A, B, start=offsets[0], stop=offsets[grid_size - 1], num=grid_size, endpoint=True
+            )
+        for i in range(grid_size, num_points):
+            results[i] = expm_multiply(A * offsets[i], B)
+        return results
+
+    # expm(A t) = Vec diag(exp(w t)) Vec^-1. The eigenvalues may be complex for
+    # non-reversible schemes, but the imaginary parts cancel in the product
+    eigenvalues, eigenvectors = np.linalg.eig(A)
+    if np.linalg.cond(eigenvectors) < EIGENVECTOR_MAX_COND:
+        coefficients = np.linalg.solve(eigenvectors, B)
+        decay = np.exp(np.multiply.outer(offsets, eigenvalues))
+        for k in range(B.shape[1]):
+            results[:, :, k] = ((decay * coefficients[:, k]) @ eigenvectors.T).real
+        return results
+
+    if grid_size:
+        results[0] = expm(A * offsets[0]) @ B
+        _walk_grid(expm(A * (offsets[1] - offsets[0])), results, grid_size)
+    for i in range(grid_size, num_points):
+        results[i] = expm(A * offsets[i]) @ B
+    return results
+
 
 # --- Simulation Engine (Corrected) ---
 
@@ -55,9 +417,13 @@ class SimulationEngine:
     """
     Orchestrates the ion channel simulation.
     """
-    def __init__(self, model: ChannelModelSchema, protocol: StimulusProtocolSchema):
+    def __init__(self, model: ChannelModel, protocol: StimulusProtocol,
+                 rng: Optional[np.random.Generator] = None):
         self.model = model
         self.protocol = protocol
+        # Source of randomness for any stochastic extension (e.g. channel noise). Seeded
+        # by default so runs are reproducible without touching the global np.random state
+        self.rng = rng if rng is not None else np.random.default_rng(0)
         self.stimulus = Stimulus(protocol)
         self.holding_map = self.stimulus.holding_map
 
@@ -72,73 +438,233 @@ class SimulationEngine:
         self.T = 293.15 # Temperature in Kelvin (20 C)
         self.z = 1      # Valence of K+
 
+        # Nernst potential (mV) per unit log(ext/int), and mmol/s of flux per pA of current
+        self._nernst_coef = (self.R * self.T) / (self.z * self.F) * 1000.0
+        self._flux_coef = 1e-12 / (self.z * self.F) * 1000.0
+
         #volume of cells currently using place holders, will need to change this to a user changable variable at some point
         self.volume_internal_L = self.holding_map.get('volume_internal_L', HoldingValue(name='volume_internal_L'))
         self.volume_external_L = self.holding_map.get('volume_external_L', HoldingValue(name='volume_external_L'))
         
         self._prepare_rate_equations()
 
+        # Transition indexing does not depend on t or y, so build it once here
+        transitions = model.transitions
+        self._tr = TransitionsSoA(
+            from_idx=np.asarray([self.state_map[t.from_state] for t in transitions], dtype=np.int32),
+            to_idx=np.asarray([self.state_map[t.to_state] for t in transitions], dtype=np.int32),
+            mult=np.asarray([t.multiplier for t in transitions], dtype=np.float64),
+            fn_idx=np.asarray([self._rate_slots[t.rate_function_id] for t in transitions], dtype=np.int32),
+        )
+        self._rate_cache = {}
+
+        # (start_ms, value_at_start, slope_per_ms) of the voltage segment being integrated
+        self._segment = (0.0, 0.0, 0.0)
+
+        # Everything the compiled RHS needs apart from y, V and the rates, bound once
+        self._rhs_args = (
+            self._tr, self.conductances,
+            self._nernst_coef, self._flux_coef,
+            self.volume_internal_L.value, self.volume_external_L.value
+        )
+
     def _prepare_rate_equations(self):
         """
         Parses all unique rate equation strings from the model using SymPy and
-        converts them into fast, callable numerical functions.
+        converts them into fast, callable numerical functions. The result is
+        memoized per set of equations so engines for the same model reuse it.
+        """
+        cache_key = tuple((func.id, func.equation) for func in self.model.rate_functions)
+        prepared = _prepared_rate_equations.get(cache_key)
+        if prepared is None:
+            prepared = self._parse_rate_equations()
+            _prepared_rate_equations[cache_key] = prepared
+        self._rate_functions, self._rate_slots, self._rate_exprs, self._rate_kernel, self._rate_batch = prepared
+        self._num_rates = len(set(self._rate_slots.values()))
+
+    def _parse_rate_equations(self):
         """
+        Does the SymPy work for _prepare_rate_equations. Returns the scalar rate
+        functions by id, each id's slot in the kernel output, the parsed expression
+        in each slot, the scalar kernel and the vectorized batch kernel.
+        """
+        # Imported here rather than at module level: sympy takes a few hundred ms to
+        # import and is only needed while preparing an engine
+        import sympy
+        from sympy.parsing.sympy_parser import parse_expr
+
         V = sympy.symbols('V')
         allowed_symbols = {'V': V, 'exp': sympy.exp}
 
-        self._rate_functions = {}
+        rate_slots = {}
+        # Slot per distinct parsed expression, so ids whose equations only differ
+        # in spelling (e.g. 'V/25' vs 'V / 25.0') are evaluated once
+        expr_slots = {}
 
         for func in self.model.rate_functions:
-            if func.id not in self._rate_functions:
+            if func.id not in rate_slots:
                 parsed_expr = parse_expr(func.equation, local_dict=allowed_symbols)
-                self._rate_functions[func.id] = sympy.lambdify(V, parsed_expr, 'numpy')
+                rate_slots[func.id] = expr_slots.setdefault(parsed_expr, len(expr_slots))
 
+        # Kernels evaluating every unique rate expression once per call;
+        # transitions sharing a formula only differ by their multiplier
+        unique_exprs = list(expr_slots)
+        rate_kernel = _build_rate_kernel(unique_exprs)
 
-    def _ode_system(self, t_s, y):
+        # Scalar functions by id, as views onto the kernel rather than separately generated code
+        rate_functions = {
+            rate_id: (lambda V, k=slot: rate_kernel(V, np.empty(len(unique_exprs)))[k])
+            for rate_id, slot in rate_slots.items()
+        }
+        return rate_functions, rate_slots, unique_exprs, rate_kernel, _build_rate_batch(unique_exprs)
+
+    def _voltage_at(self, t_s):
         """
-        The system of ODEs for the channel state probabilities, using a Q-matrix.
+        Voltage (mV) at solver time t_s (seconds) within the current segment.
+        Segments are constant or linear, so this never has to scan the epochs.
         """
-        t_ms = t_s * 1000.0
-        V = self.stimulus.get_value_at_time('Voltage', t_ms)
-        if V is None: V = 0
+        start_ms, value, slope = self._segment
+        return value + slope * (t_s * 1000.0 - start_ms)
 
-        probabilities = y[:self.num_states]
-        internal_K_mM = y[self.num_states]
-        external_K_mM = y[self.num_states + 1]
+    def _rates_at(self, V):
+        """
+        Values of the unique rate functions at V. Within a constant-voltage segment
+        every solver call asks for the same V, so results are memoized per voltage.
+        """
+        key = round(V, 6)
+        rates = self._rate_cache.get(key)
+        if rates is None:
+            # Ramps rarely revisit a voltage, so keep the cache from growing unbounded
+            if len(self._rate_cache) >= RATE_CACHE_SIZE:
+                self._rate_cache.clear()
+            try:
+                rates = self._rate_kernel(V, np.empty(self._num_rates))
+            except (ZeroDivisionError, OverflowError):
+                # math raises where NumPy gives inf/nan, so evaluate this V the batch
+                # kernel's way and let _finite_rates handle both paths identically
+                with np.errstate(all='ignore'):
+                    rates = self._rate_batch(np.array([V], dtype=np.float64))[:, 0]
+            rates = self._finite_rates(V, rates)
+            self._rate_cache[key] = rates
+        return rates
+
+    def _finite_rates(self, V, rates):
+        """
+        Checks the rates evaluated at V. A non-finite rate is replaced by its limit at V
+        when that is finite from both sides, which covers removable singularities such
+        as the 0/0 of 0.01 * (V + 55) / (1 - exp(-(V + 55) / 10)) at -55 mV. Otherwise
+        raises a ValueError naming the rate functions and the voltage.
+        """
+        bad_slots = np.flatnonzero(~np.isfinite(rates))
+        if len(bad_slots) == 0:
+            return rates
+
+        import sympy
+
+        V_symbol = sympy.symbols('V')
+        point = sympy.nsimplify(V, rational=True)
+        rates = np.array(rates, dtype=np.float64)
+        for slot in bad_slots:
+            limits = {sympy.limit(self._rate_exprs[slot], V_symbol, point, dir=side) for side in ('+', '-')}
+            limit = limits.pop() if len(limits) == 1 else sympy.nan
+            # is_real excludes infinities; float() may still overflow for huge finite limits
+            value = float(limit) if limit.is_real else np.nan
+            if not np.isfinite(value):
+                rate_ids = ", ".join(repr(rate_id) for rate_id, k in self._rate_slots.items() if k == slot)
+                raise ValueError(
+                    f"Rate function {rate_ids} is not finite at V = {V} mV "
+                    f"(evaluates to {rates[slot]}) and has no finite limit there."
+                )
+            rates[slot] = value
+        return rates
 
-        # Initialize the transition matrix Q
-        Q = np.zeros((self.num_states, self.num_states))
+    def _ode_system(self, t_s, y):
+        """
+        The system of ODEs for the channel state probabilities, using a Q-matrix.
+        """
+        V = self._voltage_at(t_s)
+        return _rhs(y, V, self._rates_at(V), *self._rhs_args)
 
-        #Build the Q-matrix using the refractored transition schema
-        for trans in self.model.transitions:
-            from_idx, to_idx = self.state_map[trans.from_state], self.state_map[trans.to_state]
-            rate = self._rate_functions[trans.rate_function_id](V) * trans.multiplier
-            Q[to_idx, from_idx] += rate
-            Q[from_idx, from_idx] -= rate
-        d_probabilities_dt = Q @ probabilities
+    def _jacobian(self, t_s, y):
+        """
+        Analytic Jacobian of _ode_system, so stiff solvers don't have to
+        approximate it with finite differences.
+        """
+        V = self._voltage_at(t_s)
+        return _jac(y, V, self._rates_at(V), *self._rhs_args)
 
-        if internal_K_mM <= 0 or external_K_mM <= 0:
-            nernst_potential = 0
+    def _propagate_constant_segment(self, V, start_s, times_s, y0, num_samples):
+        """
+        Advances the state through a constant-voltage segment without an ODE solver.
+        With V fixed the free probabilities obey dp/dt = A p + b (the last state is
+        eliminated through conservation), with the exact solution
+        p(t) = p* + expm(A (t - start)) (p(start) - p*) around the steady state p*.
+        Augmenting A with p(start) - p* as an extra column makes the same propagator
+        also return the exact integral of p, so the K+ concentrations are stepped
+        with the true charge between samples (Nernst potential held per step).
+        times_s holds the segment's output samples (num_samples of them, uniformly
+        spaced) followed by any extra points such as the segment end.
+        Returns the reduced state, as integrated by _ode_system, at each of times_s.
+        """
+        num_states = self.num_states
+        num_free = num_states - 1
+        offsets = times_s - start_s
+
+        Q = np.empty((num_states, num_states))
+        _fill_q(Q, self._rates_at(V), self._tr)
+        A_red = Q[:num_free, :num_free] - Q[:num_free, num_free:]
+        b_red = Q[:num_free, num_free]
+
+        if num_free > 0 and np.linalg.cond(A_red) < STEADY_STATE_MAX_COND:
+            p_steady = np.linalg.solve(A_red, -b_red)
+            deviation = y0[:num_free] - p_steady
+
+            # d/dt [e, q] = [A e + deviation * s, 0] with e(0) = deviation, s = 0 gives
+            # the decaying part of p(t); with e(0) = 0, s = 1 it gives its integral
+            A = np.zeros((num_states, num_states))
+            A[:num_free, :num_free] = A_red
+            A[:num_free, num_free] = deviation
+            B = np.zeros((num_states, 2))
+            B[:num_free, 0] = deviation
+            B[num_free, 1] = 1.0
+
+            propagated = _expm_multiply_at(A, B, offsets, num_samples)
+            free_probabilities = p_steady + propagated[:, :num_free, 0]
+            integral_free = p_steady * offsets[:, np.newaxis] + propagated[:, :num_free, 1]
+            g_last = self.conductances[num_free]
+            charge_nS_s = integral_free @ (self.conductances[:num_free] - g_last) + g_last * offsets
         else:
-            nernst_potential = ((self.R * self.T) / (self.z * self.F) * np.log(external_K_mM / internal_K_mM)) * 1000
-        
-        total_conductance = self.conductances @ probabilities
-        total_current_pA = total_conductance * (V - nernst_potential)
-
-
-        flux_mmol_s = (total_current_pA * 1e-12) / (self.z * self.F) * 1000
-        d_internal_K_dt = -flux_mmol_s / self.volume_internal_L
-        d_external_K_dt = flux_mmol_s / self.volume_external_L
-
-
-        dydt = np.concatenate((d_probabilities_dt, [d_internal_K_dt], [d_external_K_dt]))
-        return dydt
+            # No unique steady state (e.g. an absorbing or disconnected state at this V):
+            # propagate the full generator, augmented with p(start) in the same way
+            p_start = np.append(y0[:num_free], 1.0 - y0[:num_free].sum())
+            A = np.zeros((num_states + 1, num_states + 1))
+            A[:num_states, :num_states] = Q
+            A[:num_states, num_states] = p_start
+            B = np.zeros((num_states + 1, 2))
+            B[:num_states, 0] = p_start
+            B[num_states, 1] = 1.0
+
+            propagated = _expm_multiply_at(A, B, offsets, num_samples)
+            free_probabilities = propagated[:, :num_free, 0]
+            charge_nS_s = propagated[:, :num_states, 1] @ self.conductances
+
+        y_out = np.empty((num_free + 2, len(times_s)))
+        y_out[:num_free] = free_probabilities.T
+
+        _step_concentrations(
+            charge_nS_s, V, y0[num_free], y0[num_free + 1],
+            self._nernst_coef, self._flux_coef,
+            self.volume_internal_L.value, self.volume_external_L.value,
+            y_out[num_free], y_out[num_free + 1]
+        )
+        return y_out
 
     def run(self, duration_ms: float, steps: int):
         """
         Runs the full simulation.
         """
         print(f"🔬 Running simulation for '{self.model.channel_id}'...")
+        self._rate_cache.clear()
 
         # Initial conditions: start in the first defined state
         y0_probs = np.zeros(self.num_states)
@@ -148,40 +674,85 @@ class SimulationEngine:
         y0_int_k = self.holding_map.get('Internal-K', HoldingValue(name='Internal-K', value=140, delta=0, units='mM', type='concentration', fluxSteps=[])).value
         y0_ext_k = self.holding_map.get('External-K', HoldingValue(name='External-K', value=4, delta=0, units='mM', type='concentration', fluxSteps=[])).value
         
-        y0 = np.concatenate((y0_probs, [y0_int_k], [y0_ext_k]))
+        # The last state's probability is implied by conservation and not integrated
+        y0 = np.concatenate((y0_probs[:-1], [y0_int_k], [y0_ext_k]))
 
 
         t_span_s = [0, duration_ms / 1000.0]
         t_eval_s = np.linspace(t_span_s[0], t_span_s[1], steps)
 
-        solution = solve_ivp(
-            fun=self._ode_system,
-            t_span=t_span_s, y0=y0, t_eval=t_eval_s,
-            method='RK45', rtol=1e-6, atol=1e-9
-        )
+        # Integrate each constant/ramp voltage segment separately so the solver never
+        # has to step across a discontinuity, carrying the final state forward.
+        # Constant segments are propagated exactly; only ramps need the ODE solver.
+        # Each segment writes its samples straight into the preallocated trace
+        y_trace = np.empty((len(y0), steps))
+        filled = 0
+        segments = self.stimulus.get_segments('voltage_mV', duration_ms)
+
+        # Rates for every constant-voltage segment in one vectorized evaluation
+        constant_voltages = np.unique([value for _, _, value, slope in segments if slope == 0.0])
+        if 0 < len(constant_voltages) <= RATE_CACHE_SIZE:
+            # Non-finite values (e.g. 0/0 at a removable singularity) are resolved below
+            with np.errstate(all='ignore'):
+                batch_rates = self._rate_batch(constant_voltages)
+            for k, V in enumerate(constant_voltages):
+                self._rate_cache[round(V, 6)] = self._finite_rates(V, np.ascontiguousarray(batch_rates[:, k]))
+        for i, (start_ms, end_ms, value, slope) in enumerate(segments):
+            self._segment = (start_ms, value, slope)
+            start_s, end_s = start_ms / 1000.0, end_ms / 1000.0
+
+            if i == len(segments) - 1:
+                in_segment = (t_eval_s >= start_s) & (t_eval_s <= end_s)
+            else:
+                in_segment = (t_eval_s >= start_s) & (t_eval_s < end_s)
+            segment_t_eval = t_eval_s[in_segment]
+            num_samples = len(segment_t_eval)
+            if num_samples == 0 or segment_t_eval[-1] != end_s:
+                segment_t_eval = np.append(segment_t_eval, end_s)
+
+            if slope == 0.0:
+                segment_y = self._propagate_constant_segment(value, start_s, segment_t_eval, y0, num_samples)
+            else:
+                # Let the solver take its natural steps and sample the dense
+                # interpolant afterwards, rather than snapping to the output grid
+                solution = solve_ivp(
+                    fun=self._ode_system, jac=self._jacobian,
+                    t_span=(start_s, end_s), y0=y0, dense_output=True,
+                    method='LSODA', rtol=1e-5, atol=1e-8
+                )
+                segment_y = solution.sol(segment_t_eval)
+            y_trace[:, filled:filled + num_samples] = segment_y[:, :num_samples]
+            filled += num_samples
+            y0 = segment_y[:, -1]
+        # Only reachable for a zero duration, where there are no segments to integrate
+        y_trace[:, filled:] = y0[:, np.newaxis]
 
         # --- Post-processing ---
-        time_ms = solution.t * 1000.0
-        probabilities = solution.y[:self.num_states, :]
-        internal_K_trace = solution.y[self.num_states, :]
-        external_K_trace = solution.y[self.num_states + 1, :]
+        time_ms = t_eval_s * 1000.0
+        num_free = self.num_states - 1
+        internal_K_trace = y_trace[num_free, :]
+        external_K_trace = y_trace[num_free + 1, :]
 
         # Recalculate final traces using the time varying results
-        voltage_trace = np.array([self.stimulus.get_value_at_time('voltage_mV', t) for t in time_ms])
-        
-        # Avoid division by zero if concentrations drop to or below zero
-        # Create a mask for valid concentration values
-        valid_concs = (internal_K_trace > 0) & (external_K_trace > 0)
-        nernst_potential_trace = np.zeros_like(time_ms)
-        nernst_potential_trace[valid_concs] = ((self.R * self.T) / (self.z * self.F) * np.log(external_K_trace[valid_concs] / internal_K_trace[valid_concs])) * 1000
-
-        total_conductance_trace = self.conductances @ probabilities
-        total_current_pA_trace = total_conductance_trace * (voltage_trace - nernst_potential_trace)
+        voltage_trace = self.stimulus.get_values('voltage_mV', time_ms)
+        if voltage_trace is None:
+            voltage_trace = np.zeros_like(time_ms)
+
+        # float32 is plenty for display and halves the serialized size. The K+ traces
+        # stay float64: their changes (~1e-5 mM on ~150 mM) are below float32 resolution
+        probabilities = np.empty((self.num_states, steps), dtype=np.float32)
+        total_conductance_trace = np.empty(steps, dtype=np.float32)
+        total_current_pA_trace = np.empty(steps, dtype=np.float32)
+        nernst_potential_trace = np.empty(steps, dtype=np.float32)
+        _fill_output_traces(
+            y_trace, voltage_trace, self.conductances, self._nernst_coef,
+            probabilities, total_conductance_trace, total_current_pA_trace, nernst_potential_trace
+        )
 
         print("✅ Simulation complete.")
         return {
-            "time_ms": time_ms,
-            "voltage_mV": voltage_trace,
+            "time_ms": time_ms.astype(np.float32, copy=False),
+            "voltage_mV": voltage_trace.astype(np.float32, copy=False),
             "probabilities": probabilities,
             "total_conductance_nS": total_conductance_trace,
             "total_current_pA": total_current_pA_trace,
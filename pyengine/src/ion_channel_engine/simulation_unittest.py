@@ -1,11 +1,19 @@
+import contextlib
+import logging
+import math
 import unittest
+from unittest import mock
 import numpy as np
 from pydantic import ValidationError
+from scipy.integrate import solve_ivp
 
 # Assuming the user's files are in the same directory or accessible in the python path
-from schemas import ChannelModelSchema, StimulusProtocolSchema
+from schemas import ChannelModelSchema, StimulusProtocolSchema, ChannelModel
+import simulation
 from simulation import SimulationEngine, Stimulus
 
+logger = logging.getLogger(__name__)
+
 # --- Test Fixtures: Reusable, valid data for tests ---
 
 def create_valid_model_data():
@@ -47,6 +55,129 @@ def create_valid_protocol_data():
         ]
     }
 
+def create_holding_value_data(name, value, units, value_type, flux_steps=()):
+    """Returns a dictionary for one holding value in the format read by Stimulus."""
+    return {
+        "name": name,
+        "value": value,
+        "delta": 0.0,
+        "units": units,
+        "type": value_type,
+        "fluxSteps": [dict(step, delta=0.0) for step in flux_steps]
+    }
+
+def create_engine_protocol_data(voltage_mV=-80.0, voltage_steps=None):
+    """
+    Returns create_valid_protocol_data in the holding value / flux step format read
+    by the engine: the same K+ concentrations and cell volumes, holding at voltage_mV
+    with a step to +40 mV over [100, 300) ms unless other voltage_steps are given.
+    """
+    if voltage_steps is None:
+        voltage_steps = [{"type": "Step", "value": 40.0, "time": 100.0, "deltaTime": 200.0}]
+    return {
+        "protocol_id": "test_step",
+        "holding_values": [
+            create_holding_value_data("voltage_mV", voltage_mV, "mV", "voltage", voltage_steps),
+            create_holding_value_data("Internal-K", 140.0, "mM", "concentration"),
+            create_holding_value_data("External-K", 5.0, "mM", "concentration"),
+            create_holding_value_data("volume_internal_L", 1e-12, "L", "concentration"), # 1 pL
+            create_holding_value_data("volume_external_L", 1e-6, "L", "concentration")   # 1 uL
+        ]
+    }
+
+def create_flux_protocol_data():
+    """
+    Returns a dictionary for a stimulus protocol in the holding value / flux step
+    format read by Stimulus: the same voltage step as create_valid_protocol_data,
+    plus variables with a ramp, overlapping epochs, an epoch that outlasts the
+    sweep, and a step followed by a ramp.
+    """
+    return {
+        "protocol_id": "test_flux",
+        "holding_values": [
+            create_holding_value_data("voltage_mV", -80.0, "mV", "voltage", [
+                {"type": "Step", "value": 40.0, "time": 100.0, "deltaTime": 200.0}
+            ]),
+            create_holding_value_data("ramp_mV", -80.0, "mV", "voltage", [
+                {"type": "Ramp", "value": 20.0, "time": 100.0, "deltaTime": 200.0}
+            ]),
+            # The two steps overlap during [200, 300); the first listed wins
+            create_holding_value_data("overlap_mV", 0.0, "mV", "voltage", [
+                {"type": "Step", "value": 10.0, "time": 100.0, "deltaTime": 200.0},
+                {"type": "Step", "value": 20.0, "time": 200.0, "deltaTime": 200.0}
+            ]),
+            create_holding_value_data("overrun_mV", 0.0, "mV", "voltage", [
+                {"type": "Step", "value": 30.0, "time": 250.0, "deltaTime": 1000.0}
+            ]),
+            create_holding_value_data("step_ramp_mV", -80.0, "mV", "voltage", [
+                {"type": "Step", "value": 0.0, "time": 10.0, "deltaTime": 10.0},
+                {"type": "Ramp", "value": 20.0, "time": 30.0, "deltaTime": 20.0}
+            ]),
+        ]
+    }
+
+def create_three_state_model_data():
+    """Returns a dictionary for a three-state (C1 <-> C2 <-> O) channel with fast kinetics."""
+    return {
+        "channel_id": "test_three_state",
+        "states": [
+            {"id": "C1", "name": "Closed 1", "conductance": 0.0},
+            {"id": "C2", "name": "Closed 2", "conductance": 0.0},
+            {"id": "O", "name": "Open", "conductance": 20.0} # nS
+        ],
+        "rate_functions": [
+            {"id": "alpha", "equation": "200 * exp(V / 25.0)"},
+            {"id": "beta", "equation": "100 * exp(-V / 40.0)"}
+        ],
+        "transitions": [
+            {"from": "C1", "to": "C2", "rate_function_id": "alpha", "multiplier": 2.0},
+            {"from": "C2", "to": "C1", "rate_function_id": "beta"},
+            {"from": "C2", "to": "O", "rate_function_id": "alpha"},
+            {"from": "O", "to": "C2", "rate_function_id": "beta", "multiplier": 2.0}
+        ]
+    }
+
+def create_absorbing_model_data():
+    """Returns a dictionary for a C <-> O -> I channel whose inactivated state I is absorbing."""
+    return {
+        "channel_id": "test_absorbing",
+        "states": [
+            {"id": "C", "name": "Closed", "conductance": 0.0},
+            {"id": "O", "name": "Open", "conductance": 20.0}, # nS
+            {"id": "I", "name": "Inactivated", "conductance": 0.0}
+        ],
+        "rate_functions": [
+            {"id": "alpha", "equation": "200 * exp(V / 25.0)"},
+            {"id": "beta", "equation": "100 * exp(-V / 40.0)"},
+            {"id": "gamma", "equation": "30"}
+        ],
+        "transitions": [
+            {"from": "C", "to": "O", "rate_function_id": "alpha"},
+            {"from": "O", "to": "C", "rate_function_id": "beta"},
+            {"from": "O", "to": "I", "rate_function_id": "gamma"}
+        ]
+    }
+
+def create_step_ramp_protocol_data():
+    """
+    Returns a dictionary for an engine protocol: a voltage step to +40 mV over
+    [10, 30) ms, then a ramp from -80 towards +20 mV over [40, 60) ms, with a
+    small internal volume so the K+ concentrations move noticeably.
+    """
+    return {
+        "protocol_id": "test_step_ramp",
+        "holding_values": [
+            create_holding_value_data("voltage_mV", -80.0, "mV", "voltage", [
+                {"type": "Step", "value": 40.0, "time": 10.0, "deltaTime": 20.0},
+                {"type": "Ramp", "value": 20.0, "time": 40.0, "deltaTime": 20.0}
+            ]),
+            create_holding_value_data("Internal-K", 140.0, "mM", "concentration"),
+            create_holding_value_data("External-K", 5.0, "mM", "concentration"),
+            create_holding_value_data("volume_internal_L", 1e-12, "L", "concentration"), # 1 pL
+            create_holding_value_data("volume_external_L", 1e-6, "L", "concentration")   # 1 uL
+        ]
+    }
+
 
 # --- Test Cases ---
 
@@ -56,14 +187,14 @@ class TestSchemas(unittest.TestCase):
     def test_valid_model_passes(self):
         """Check that a correctly structured model validates successfully."""
         try:
-            ChannelModelSchema(**create_valid_model_data())
+            ChannelModelSchema.model_validate(create_valid_model_data())
         except ValidationError as e:
             self.fail(f"Valid model data failed validation: {e}")
 
     def test_valid_protocol_passes(self):
         """Check that a correctly structured protocol validates successfully."""
         try:
-            StimulusProtocolSchema(**create_valid_protocol_data())
+            StimulusProtocolSchema.model_validate(create_valid_protocol_data())
         except ValidationError as e:
             self.fail(f"Valid protocol data failed validation: {e}")
 
@@ -74,7 +205,7 @@ class TestSchemas(unittest.TestCase):
             {"from": "C", "to": "Z_INVALID", "rate_function_id": "alpha"}
         )
         with self.assertRaisesRegex(ValueError, "is not a defined state id"):
-            ChannelModelSchema(**invalid_data)
+            ChannelModelSchema.model_validate(invalid_data)
 
     def test_model_fails_with_invalid_rate_function_id(self):
         """Ensure model validation fails if a transition refers to a non-existent rate function."""
@@ -83,7 +214,7 @@ class TestSchemas(unittest.TestCase):
             {"from": "C", "to": "O", "rate_function_id": "gamma_INVALID"}
         )
         with self.assertRaisesRegex(ValueError, "is not a defined function id"):
-            ChannelModelSchema(**invalid_data)
+            ChannelModelSchema.model_validate(invalid_data)
             
     def test_protocol_fails_with_invalid_epoch_variable(self):
         """Ensure protocol validation fails if an epoch targets an invalid variable."""
@@ -95,7 +226,7 @@ class TestSchemas(unittest.TestCase):
             "value": 37.0
         })
         with self.assertRaisesRegex(ValueError, "is not a valid variable"):
-            StimulusProtocolSchema(**invalid_data)
+            StimulusProtocolSchema.model_validate(invalid_data)
 
 
 class TestStimulus(unittest.TestCase):
@@ -103,36 +234,87 @@ class TestStimulus(unittest.TestCase):
     
     def setUp(self):
         """Set up a stimulus object for all tests in this class."""
-        protocol_schema = StimulusProtocolSchema(**create_valid_protocol_data())
+        protocol_schema = StimulusProtocolSchema.model_validate(create_flux_protocol_data())
         self.stimulus = Stimulus(protocol_schema)
-        self.holding_voltage = protocol_schema.holding_values.voltage_mV
-
-    def test_returns_holding_value_before_epochs(self):
-        """Test that the holding value is returned for a time before any epoch starts."""
-        self.assertEqual(self.stimulus.get_value_at_time('voltage_mV', 50.0), self.holding_voltage)
+        self.holding_voltage = protocol_schema.holding_values[0].value
 
-    def test_returns_epoch_value_during_epoch(self):
-        """Test that the correct epoch value is returned within an epoch's time range."""
-        self.assertEqual(self.stimulus.get_value_at_time('voltage_mV', 150.0), 40.0)
-
-    def test_returns_value_at_epoch_start(self):
-        """Test that the epoch value is active at its exact start time."""
-        self.assertEqual(self.stimulus.get_value_at_time('voltage_mV', 100.0), 40.0)
+    def test_get_value_at_time(self):
+        """
+        Test the value returned before, during, at the exact start of, and at the
+        exact end of an epoch. The epoch is active for t in [100, 300), so the value
+        reverts to holding at its end time (start 100 + duration 200 = 300).
+        Ramps interpolate from the holding value, the first listed epoch wins where
+        epochs overlap, and an unknown variable has no value.
+        """
+        cases = [
+            ('voltage_mV', 50.0, self.holding_voltage),
+            ('voltage_mV', 150.0, 40.0),
+            ('voltage_mV', 100.0, 40.0),
+            ('voltage_mV', 300.0, self.holding_voltage),
+            # Ramp from -80 towards 20 over [100, 300): 0.5 mV/ms
+            ('ramp_mV', 100.0, -80.0),
+            ('ramp_mV', 150.0, -55.0),
+            ('ramp_mV', 250.0, -5.0),
+            ('ramp_mV', 300.0, -80.0),
+            ('overlap_mV', 150.0, 10.0),
+            ('overlap_mV', 250.0, 10.0),
+            ('overlap_mV', 350.0, 20.0),
+            ('overlap_mV', 400.0, 0.0),
+            # Still active well past the end of a 500 ms sweep
+            ('overrun_mV', 600.0, 30.0),
+            ('temperature_C', 50.0, None),
+        ]
+        for variable, t_ms, expected in cases:
+            with self.subTest(variable=variable, t_ms=t_ms):
+                value = self.stimulus.get_value_at_time(variable, t_ms)
+                if expected is None:
+                    self.assertIsNone(value)
+                else:
+                    self.assertAlmostEqual(value, expected)
 
-    def test_returns_holding_value_at_epoch_end(self):
-        """Test that the value reverts to holding at the exact end time of an epoch."""
-        # End time is start (100) + duration (200) = 300. The epoch is active for t in [100, 300).
-        self.assertEqual(self.stimulus.get_value_at_time('voltage_mV', 300.0), self.holding_voltage)
+    def test_get_segments(self):
+        """
+        Test that [0, duration] is split at every epoch boundary inside it into
+        (start, end, value at start, slope) pieces.
+        """
+        cases = [
+            ('step_ramp_mV', 60.0, [
+                (0.0, 10.0, -80.0, 0.0),
+                (10.0, 20.0, 0.0, 0.0),
+                (20.0, 30.0, -80.0, 0.0),
+                (30.0, 50.0, -80.0, 5.0),
+                (50.0, 60.0, -80.0, 0.0),
+            ]),
+            # Boundaries past the sweep are dropped, the last piece ends at the duration
+            ('overrun_mV', 500.0, [
+                (0.0, 250.0, 0.0, 0.0),
+                (250.0, 500.0, 30.0, 0.0),
+            ]),
+            ('temperature_C', 100.0, [
+                (0.0, 100.0, 0.0, 0.0),
+            ]),
+        ]
+        for variable, duration_ms, expected in cases:
+            with self.subTest(variable=variable):
+                segments = self.stimulus.get_segments(variable, duration_ms)
+                self.assertEqual(len(segments), len(expected))
+                for segment, expected_segment in zip(segments, expected):
+                    np.testing.assert_allclose(segment, expected_segment)
 
 
 class TestSimulationEngine(unittest.TestCase):
     """Tests for the main SimulationEngine class and its core logic."""
 
-    def setUp(self):
-        """Prepare a standard engine instance for testing."""
-        self.model = ChannelModelSchema(**create_valid_model_data())
-        self.protocol = StimulusProtocolSchema(**create_valid_protocol_data())
-        self.engine = SimulationEngine(self.model, self.protocol)
+    @classmethod
+    def setUpClass(cls):
+        """
+        Prepare a standard engine instance shared by the tests. run() doesn't carry
+        state between calls, so tests needing another setup build their own engine.
+        """
+        cls.model = ChannelModel.model_validate(create_valid_model_data())
+        cls.protocol = StimulusProtocolSchema.model_validate(create_engine_protocol_data())
+        cls.rng = np.random.default_rng(42)
+        cls.engine = SimulationEngine(cls.model, cls.protocol, rng=cls.rng)
 
     def test_rate_equation_parsing(self):
         """Verify that a string equation is correctly parsed and evaluated."""
@@ -144,14 +326,22 @@ class TestSimulationEngine(unittest.TestCase):
         # Test case 2: V = 50
         self.assertAlmostEqual(rate_func(50), 0.1 * np.exp(50 / 25.0))
 
+    def test_random_generator(self):
+        """An injected generator is used as-is; without one, the engine gets a fixed-seed default."""
+        self.assertIs(self.engine.rng, self.rng)
+
+        default_draws = [SimulationEngine(self.model, self.protocol).rng.random(5) for _ in range(2)]
+        np.testing.assert_array_equal(default_draws[0], default_draws[1])
+        np.testing.assert_array_equal(default_draws[0], np.random.default_rng(0).random(5))
+
     def test_conservation_of_probability(self):
         """The sum of state probabilities must always be 1.0."""
         results = self.engine.run(duration_ms=50, steps=100)
         prob_sum = np.sum(results["probabilities"], axis=0)
 
-        print(f"The current prob_sum = '{prob_sum}'")
+        logger.debug("The current prob_sum = '%s'", prob_sum)
         # Assert that all values in the sum array are close to 1.0
-        self.assertTrue(np.allclose(prob_sum, 1.0), "Sum of probabilities deviates from 1.0")
+        self.assertLess(np.abs(prob_sum - 1.0).max(), 1e-6, "Sum of probabilities deviates from 1.0")
 
     def test_initial_conditions(self):
         """Check if the simulation starts in the correct state."""
@@ -161,29 +351,26 @@ class TestSimulationEngine(unittest.TestCase):
         # All other state probabilities should be 0.0 at t=0
         self.assertAlmostEqual(np.sum(results["probabilities"][1:, 0]), 0.0)
         # Initial concentrations should match the protocol
-        self.assertAlmostEqual(results["internal_K_mM"][0], self.protocol.holding_values.internal_K_mM)
-        self.assertAlmostEqual(results["external_K_mM"][0], self.protocol.holding_values.external_K_mM)
+        self.assertAlmostEqual(results["internal_K_mM"][0], self.engine.holding_map["Internal-K"].value)
+        self.assertAlmostEqual(results["external_K_mM"][0], self.engine.holding_map["External-K"].value)
 
     def test_equilibrium_at_nernst_potential(self):
         """At Nernst potential, net current and concentration change should be zero."""
-        protocol_data = create_valid_protocol_data()
-        
         # Calculate Nernst potential for K+
         R, T, F, z = 8.314, 293.15, 96485, 1
-        Ki = protocol_data["holding_values"]["internal_K_mM"]
-        Ko = protocol_data["holding_values"]["external_K_mM"]
+        Ki = self.engine.holding_map["Internal-K"].value
+        Ko = self.engine.holding_map["External-K"].value
         nernst_potential_mV = ((R * T) / (z * F) * np.log(Ko / Ki)) * 1000
         
-        # Set holding voltage to Nernst and remove epochs
-        protocol_data["holding_values"]["voltage_mV"] = nernst_potential_mV
-        protocol_data["epochs"] = [] 
+        # Hold the voltage at Nernst with no epochs
+        protocol_data = create_engine_protocol_data(voltage_mV=nernst_potential_mV, voltage_steps=[])
         
-        protocol = StimulusProtocolSchema(**protocol_data)
+        protocol = StimulusProtocolSchema.model_validate(protocol_data)
         engine = SimulationEngine(self.model, protocol)
         results = engine.run(duration_ms=100, steps=100)
         
         # Current should be zero (or very close)
-        self.assertTrue(np.allclose(results["total_current_pA"], 0.0, atol=1e-9))
+        self.assertLessEqual(np.abs(results["total_current_pA"]).max(), 1e-9)
         # Concentrations should not change
         self.assertAlmostEqual(results["internal_K_mM"][0], results["internal_K_mM"][-1])
         self.assertAlmostEqual(results["external_K_mM"][0], results["external_K_mM"][-1])
@@ -191,16 +378,14 @@ class TestSimulationEngine(unittest.TestCase):
     def test_ion_concentration_dynamics(self):
         """Verify concentrations change correctly in response to sustained current."""
         # Use a protocol that holds voltage at +40mV to drive K+ out
-        protocol_data = create_valid_protocol_data()
-        protocol_data["holding_values"]["voltage_mV"] = 40.0
-        protocol_data["epochs"] = []
+        protocol_data = create_engine_protocol_data(voltage_mV=40.0, voltage_steps=[])
         
-        protocol = StimulusProtocolSchema(**protocol_data)
+        protocol = StimulusProtocolSchema.model_validate(protocol_data)
         engine = SimulationEngine(self.model, protocol)
         results = engine.run(duration_ms=200, steps=200)
 
         # Check for a sustained positive (outward) current
-        self.assertTrue(np.all(results["total_current_pA"][10:] > 0)) # Check after initial transient
+        self.assertGreater(results["total_current_pA"][10:].min(), 0) # Check after initial transient
         # Internal K+ should decrease
         self.assertLess(results["internal_K_mM"][-1], results["internal_K_mM"][0])
         # External K+ should increase
@@ -213,17 +398,195 @@ class TestSimulationEngine(unittest.TestCase):
         for state in model_data["states"]:
             state["conductance"] = 0.0
         
-        zero_conductance_model = ChannelModelSchema(**model_data)
+        zero_conductance_model = ChannelModel.model_validate(model_data)
         engine = SimulationEngine(zero_conductance_model, self.protocol)
         results = engine.run(duration_ms=300, steps=100)
 
         # Total conductance and current must be zero throughout
-        self.assertTrue(np.all(results["total_conductance_nS"] == 0.0))
-        self.assertTrue(np.all(results["total_current_pA"] == 0.0))
+        self.assertEqual(np.abs(results["total_conductance_nS"]).max(), 0.0)
+        self.assertEqual(np.abs(results["total_current_pA"]).max(), 0.0)
         # Concentrations should not change if there's no current
         self.assertAlmostEqual(results["internal_K_mM"][0], results["internal_K_mM"][-1])
         self.assertAlmostEqual(results["external_K_mM"][0], results["external_K_mM"][-1])
 
+    def test_rate_singularity(self):
+        """
+        A step onto the 0/0 point of a rate equation uses the rate's limit there, and a
+        pole raises a ValueError, whether the rates come from the batch prefill or the
+        scalar kernel (RATE_CACHE_SIZE 0 skips the prefill).
+        """
+        model_data = create_valid_model_data()
+        protocol = StimulusProtocolSchema.model_validate(create_engine_protocol_data(voltage_steps=[
+            {"type": "Step", "value": -55.0, "time": 100.0, "deltaTime": 200.0}
+        ]))
+
+        model_data["rate_functions"][0]["equation"] = "0.01 * (V + 55) / (1 - exp(-(V + 55) / 10))"
+        removable_model = ChannelModel.model_validate(model_data)
+        model_data["rate_functions"][0]["equation"] = "0.01 / (V + 55)"
+        pole_model = ChannelModel.model_validate(model_data)
+
+        probabilities = []
+        for cache_size in (simulation.RATE_CACHE_SIZE, 0):
+            with self.subTest(cache_size=cache_size), mock.patch.object(simulation, 'RATE_CACHE_SIZE', cache_size):
+                engine = SimulationEngine(removable_model, protocol)
+                results = engine.run(duration_ms=400, steps=401)
+                self.assertAlmostEqual(engine._rates_at(-55.0)[engine._rate_slots['alpha']], 0.1)
+                self.assertTrue(np.isfinite(results["probabilities"]).all())
+                probabilities.append(results["probabilities"])
+
+                with self.assertRaisesRegex(ValueError, r"'alpha'.*-55"):
+                    SimulationEngine(pole_model, protocol).run(duration_ms=400, steps=401)
+        np.testing.assert_allclose(probabilities[0], probabilities[1], rtol=1e-6)
+
+
+class TestSegmentIntegration(unittest.TestCase):
+    """
+    Checks run() against an independent, tight-tolerance solve_ivp reference,
+    through every branch of the constant-voltage segment propagator.
+    """
+
+    DURATION_MS = 80.0
+    STEPS = 161
+    # (start_ms, end_ms, value_at_start, slope_per_ms) of the step/ramp protocol's voltage
+    VOLTAGE_PIECES = [
+        (0.0, 10.0, -80.0, 0.0),
+        (10.0, 30.0, 40.0, 0.0),
+        (30.0, 40.0, -80.0, 0.0),
+        (40.0, 60.0, -80.0, 5.0),
+        (60.0, 80.0, -80.0, 0.0),
+    ]
+    # Threshold overrides forcing each constant-segment branch. The defaults take the
+    # reduced steady-state form with a diagonalized propagator. The augmented full
+    # generator is defective (its zero eigenvalue has p(start) coupled in), so with
+    # the steady state disabled the eigenvector check itself falls back to expm stepping
+    BRANCHES = {
+        'reduced_eigen': {},
+        'reduced_expm_walk': {'EIGENVECTOR_MAX_COND': 0.0},
+        'reduced_expm_multiply': {'DENSE_EXPM_MAX_STATES': 0},
+        'full_expm_walk': {'STEADY_STATE_MAX_COND': 0.0},
+        'full_expm_multiply': {'STEADY_STATE_MAX_COND': 0.0, 'DENSE_EXPM_MAX_STATES': 0},
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        """Validate the shared protocol once for the class."""
+        cls.protocol_data = create_step_ramp_protocol_data()
+        cls.protocol = StimulusProtocolSchema.model_validate(cls.protocol_data)
+
+    def _reference(self, model_data):
+        """
+        Integrates all N state probabilities plus the K+ concentrations with Radau at
+        tight tolerances, piece by piece, building Q straight from the model data.
+        Returns the probabilities and the internal and external K+ traces.
+        """
+        state_index = {state["id"]: i for i, state in enumerate(model_data["states"])}
+        conductances = np.array([state["conductance"] for state in model_data["states"]])
+        equations = {func["id"]: func["equation"] for func in model_data["rate_functions"]}
+        holding = {hv["name"]: hv["value"] for hv in self.protocol_data["holding_values"]}
+        num_states = len(conductances)
+
+        R, T, F, z = 8.314, 293.15, 96485, 1
+        nernst_coef = (R * T) / (z * F) * 1000.0
+        flux_coef = 1e-12 / (z * F) * 1000.0
+
+        def rhs(t_s, y, start_ms, value, slope):
+            V = value + slope * (t_s * 1000.0 - start_ms)
+            Q = np.zeros((num_states, num_states))
+            for transition in model_data["transitions"]:
+                # The equations are trusted fixture strings of V and exp
+                rate = eval(equations[transition["rate_function_id"]], {"exp": math.exp, "V": V})
+                rate *= transition.get("multiplier", 1.0)
+                i, j = state_index[transition["from"]], state_index[transition["to"]]
+                Q[j, i] += rate
+                Q[i, i] -= rate
+            p, internal_K_mM, external_K_mM = y[:num_states], y[num_states], y[num_states + 1]
+            nernst_potential = nernst_coef * math.log(external_K_mM / internal_K_mM)
+            flux_mmol = (conductances @ p) * (V - nernst_potential) * flux_coef
+            return np.concatenate((Q @ p, [-flux_mmol / holding["volume_internal_L"], flux_mmol / holding["volume_external_L"]]))
+
+        time_s = np.linspace(0.0, self.DURATION_MS / 1000.0, self.STEPS)
+        y = np.zeros(num_states + 2)
+        y[0] = 1.0
+        y[num_states], y[num_states + 1] = holding["Internal-K"], holding["External-K"]
+        trace = np.empty((num_states + 2, self.STEPS))
+        for start_ms, end_ms, value, slope in self.VOLTAGE_PIECES:
+            start_s, end_s = start_ms / 1000.0, end_ms / 1000.0
+            solution = solve_ivp(
+                rhs, (start_s, end_s), y, method='Radau', rtol=1e-10, atol=1e-12,
+                args=(start_ms, value, slope), dense_output=True
+            )
+            in_piece = (time_s >= start_s) & (time_s <= end_s)
+            trace[:, in_piece] = solution.sol(time_s[in_piece])
+            y = solution.y[:, -1]
+        return trace[:num_states], trace[num_states], trace[num_states + 1]
+
+    def _assert_branches_match_reference(self, model_data):
+        """
+        Runs the engine through every propagator branch. Before the ramp only the
+        exact propagator is involved, so probabilities must match the reference to
+        float32 resolution; the ramp is integrated by LSODA at rtol=1e-5, so the whole
+        trace gets a looser bound. The branches must all agree with each other.
+        """
+        model = ChannelModel.model_validate(model_data)
+        probabilities, internal_K_mM, external_K_mM = self._reference(model_data)
+        before_ramp = np.linspace(0.0, self.DURATION_MS, self.STEPS) < 40.0
+
+        baseline = None
+        for branch, overrides in self.BRANCHES.items():
+            with self.subTest(branch=branch), contextlib.ExitStack() as stack:
+                for name, value in overrides.items():
+                    stack.enter_context(mock.patch.object(simulation, name, value))
+                results = SimulationEngine(model, self.protocol).run(self.DURATION_MS, self.STEPS)
+
+                np.testing.assert_allclose(
+                    results["probabilities"][:, before_ramp], probabilities[:, before_ramp], rtol=0, atol=1e-7
+                )
+                np.testing.assert_allclose(results["probabilities"], probabilities, rtol=0, atol=2e-5)
+                np.testing.assert_allclose(results["internal_K_mM"], internal_K_mM, rtol=1e-7)
+                np.testing.assert_allclose(results["external_K_mM"], external_K_mM, rtol=1e-7)
+
+                if baseline is None:
+                    baseline = results
+                else:
+                    np.testing.assert_allclose(results["probabilities"], baseline["probabilities"], rtol=0, atol=1e-7)
+                    np.testing.assert_allclose(results["internal_K_mM"], baseline["internal_K_mM"], rtol=1e-11)
+                    np.testing.assert_allclose(results["external_K_mM"], baseline["external_K_mM"], rtol=1e-11)
+
+    def test_step_and_ramp_match_reference(self):
+        """Every propagator branch reproduces the reference through a step and a ramp."""
+        self._assert_branches_match_reference(create_three_state_model_data())
+
+    def test_absorbing_state_matches_reference(self):
+        """A model with an absorbing state reproduces the reference in every branch."""
+        self._assert_branches_match_reference(create_absorbing_model_data())
+
+    def test_jacobian_matches_finite_differences(self):
+        """
+        The analytic Jacobian, K+ rows included, matches a central-difference Jacobian
+        of the ODE system at a non-equilibrium state partway up the ramp. Rows span
+        many orders of magnitude, so each is compared relative to its largest entry.
+        """
+        # Reduced state: free probabilities, then internal and external K+ (mM)
+        y = np.array([0.5, 0.3, 139.0, 5.5])
+        t_s = 0.045
+
+        for model_data in (create_three_state_model_data(), create_absorbing_model_data()):
+            with self.subTest(channel_id=model_data["channel_id"]):
+                engine = SimulationEngine(ChannelModel.model_validate(model_data), self.protocol)
+                engine._segment = (40.0, -80.0, 5.0)
+
+                jacobian = engine._jacobian(t_s, y)
+                finite_difference = np.empty_like(jacobian)
+                for j in range(len(y)):
+                    step = np.zeros_like(y)
+                    step[j] = 1e-6 * max(1.0, abs(y[j]))
+                    finite_difference[:, j] = (
+                        engine._ode_system(t_s, y + step) - engine._ode_system(t_s, y - step)
+                    ) / (2 * step[j])
+
+                row_scale = np.abs(finite_difference).max(axis=1, keepdims=True)
+                np.testing.assert_allclose(jacobian / row_scale, finite_difference / row_scale, rtol=0, atol=1e-7)
+
 
 # --- Main execution block to run tests ---
 if __name__ == '__main__':